@@ -1,12 +1,19 @@
 #!/usr/bin/env python3
 import os
 import socket
+import threading
 import time
 from contextlib import closing
+from dataclasses import dataclass
 
 import psycopg2
-from psycopg2 import OperationalError
-from prometheus_client import start_http_server, Gauge
+import psycopg2.extensions
+import psycopg2.pool
+from psycopg2 import InterfaceError, OperationalError
+from psycopg2.errors import QueryCanceled
+from prometheus_client import start_http_server
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from prometheus_client.registry import REGISTRY, Collector
 
 
 def env(name, default=None, required=False, cast=str):
@@ -23,191 +30,341 @@ def env(name, default=None, required=False, cast=str):
 
 # ---------- Настройки из ENV ----------
 
-PG_HOST = env("AF_PG_HOST", "127.0.0.1")
-PG_PORT = env("AF_PG_PORT", "5432", cast=int)
-PG_DB = env("AF_PG_DB", "airflow")
-PG_USER = env("AF_PG_USER", "airflow")
-PG_PASSWORD = env("AF_PG_PASSWORD", required=True)
 
-SCRAPE_INTERVAL = env("AF_SCRAPE_INTERVAL_SECONDS", 10, cast=int)
-
-EXPORTER_PORT = env("AF_EXPORTER_PORT", 9105, cast=int)
-EXPORTER_ADDR = env("AF_EXPORTER_ADDR", "0.0.0.0")
-
-# Пороги (для airflow_pg_status, 0=OK,1=WARNING,2=CRITICAL)
-WARN_IDLE_IN_TX = env("AF_WARN_IDLE_IN_TX", 5, cast=int)
-WARN_ACTIVE_CONN = env("AF_WARN_ACTIVE_CONN", 80, cast=int)
-WARN_LATENCY_MS = env("AF_WARN_LATENCY_MS", 500, cast=int)
+@dataclass(frozen=True)
+class Config:
+    pg_host: str
+    pg_port: int
+    pg_db: str
+    pg_user: str
+    pg_password: str
+
+    # Несколько Prometheus в пределах cache_ttl получат один и тот же результат
+    scrape_interval: int
+    cache_ttl: float
+
+    exporter_port: int
+    exporter_addr: str
+
+    # Пороги (для airflow_pg_status, 0=OK,1=WARNING,2=CRITICAL)
+    warn_idle_in_tx: int
+    warn_active_conn: int
+    warn_latency_ms: int
+
+
+def load_config() -> Config:
+    """Читаем настройки из ENV один раз при старте."""
+    scrape_interval = env("AF_SCRAPE_INTERVAL_SECONDS", 10, cast=int)
+    return Config(
+        pg_host=env("AF_PG_HOST", "127.0.0.1"),
+        pg_port=env("AF_PG_PORT", "5432", cast=int),
+        pg_db=env("AF_PG_DB", "airflow"),
+        pg_user=env("AF_PG_USER", "airflow"),
+        pg_password=env("AF_PG_PASSWORD", required=True),
+        scrape_interval=scrape_interval,
+        cache_ttl=scrape_interval / 2,
+        exporter_port=env("AF_EXPORTER_PORT", 9105, cast=int),
+        exporter_addr=env("AF_EXPORTER_ADDR", "0.0.0.0"),
+        warn_idle_in_tx=env("AF_WARN_IDLE_IN_TX", 5, cast=int),
+        warn_active_conn=env("AF_WARN_ACTIVE_CONN", 80, cast=int),
+        warn_latency_ms=env("AF_WARN_LATENCY_MS", 500, cast=int),
+    )
 
 
 # ---------- Prometheus метрики ----------
 
-# 1 если всё ок (подключились и SELECT 1 прошёл), иначе 0
-PG_UP = Gauge("airflow_pg_up", "Airflow Postgres availability (1=up,0=down)")
-
-# Время ответа SELECT 1, миллисекунды (если ошибка, выставляем -1)
-PG_LATENCY_MS = Gauge("airflow_pg_latency_ms", "Airflow Postgres SELECT 1 latency in ms")
-
-# Общее кол-во коннектов к БД (по datname)
-PG_DB_TOTAL = Gauge("airflow_pg_db_connections_total", "Total connections to Airflow DB")
-PG_DB_ACTIVE = Gauge("airflow_pg_db_connections_active", "Active connections to Airflow DB")
-PG_DB_IDLE_IN_TX = Gauge(
-    "airflow_pg_db_connections_idle_in_tx", "Idle in transaction connections to Airflow DB"
+# Ключ в результате scrape_once -> (имя метрики, описание)
+METRICS = (
+    # 1 если всё ок (подключились и запрос прошёл), иначе 0
+    ("up", "airflow_pg_up", "Airflow Postgres availability (1=up,0=down)"),
+    # Время ответа запроса к pg_stat_activity, миллисекунды (если ошибка, выставляем -1)
+    (
+        "latency_ms",
+        "airflow_pg_latency_ms",
+        "Airflow Postgres pg_stat_activity query latency in ms",
+    ),
+    # Общее кол-во коннектов к БД (по datname)
+    ("db_total", "airflow_pg_db_connections_total", "Total connections to Airflow DB"),
+    ("db_active", "airflow_pg_db_connections_active", "Active connections to Airflow DB"),
+    (
+        "db_idle_in_tx",
+        "airflow_pg_db_connections_idle_in_tx",
+        "Idle in transaction connections to Airflow DB",
+    ),
+    # Конкретно коннекты от Airflow/Celery по application_name
+    (
+        "af_total",
+        "airflow_pg_af_connections_total",
+        "Total Airflow/Celery connections to Airflow DB",
+    ),
+    (
+        "af_active",
+        "airflow_pg_af_connections_active",
+        "Active Airflow/Celery connections to Airflow DB",
+    ),
+    (
+        "af_idle_in_tx",
+        "airflow_pg_af_connections_idle_in_tx",
+        "Idle in transaction Airflow/Celery connections to Airflow DB",
+    ),
+    # Интегральный статус: 0=OK, 1=WARNING, 2=CRITICAL
+    (
+        "status",
+        "airflow_pg_status",
+        "Airflow Postgres health status (0=OK,1=WARNING,2=CRITICAL)",
+    ),
 )
 
-# Конкретно коннекты от Airflow/Celery по application_name
-PG_AF_TOTAL = Gauge(
-    "airflow_pg_af_connections_total", "Total Airflow/Celery connections to Airflow DB"
-)
-PG_AF_ACTIVE = Gauge(
-    "airflow_pg_af_connections_active", "Active Airflow/Celery connections to Airflow DB"
-)
-PG_AF_IDLE_IN_TX = Gauge(
-    "airflow_pg_af_connections_idle_in_tx",
-    "Idle in transaction Airflow/Celery connections to Airflow DB",
-)
+# Возраст отданных значений (0 — опрос БД был выполнен прямо сейчас)
+SCRAPE_AGE_DOC = "Age of cached Airflow Postgres healthcheck results in seconds"
+
+# Сколько раз запрос к pg_stat_activity упёрся в statement_timeout
+# (CounterMetricFamily сам добавит суффикс _total)
+SCRAPE_TIMEOUTS_DOC = "Airflow Postgres healthcheck queries cancelled by statement_timeout"
+
+
+# ---------- Запрос к Postgres ----------
+
+# Стата по сессиям одним запросом, готовится один раз на соединение.
+# Он же служит проверкой живости: отдельный SELECT 1 не нужен.
+# application_name задаётся конфигом клиентов, поэтому регистр
+# известен и достаточно LIKE без case-folding
+STATS_PREPARE_SQL = """
+PREPARE pg_hc_stats(text) AS
+SELECT
+    COUNT(*) AS db_total,
+    COUNT(*) FILTER (WHERE state = 'active') AS db_active,
+    COUNT(*) FILTER (WHERE state = 'idle in transaction') AS db_idle_in_tx,
+    COUNT(*) FILTER (WHERE application_name LIKE 'airflow%'
+                        OR application_name LIKE 'celery%') AS af_total,
+    COUNT(*) FILTER (WHERE state = 'active'
+                       AND (application_name LIKE 'airflow%'
+                            OR application_name LIKE 'celery%')) AS af_active,
+    COUNT(*) FILTER (WHERE state = 'idle in transaction'
+                       AND (application_name LIKE 'airflow%'
+                            OR application_name LIKE 'celery%')) AS af_idle_in_tx
+FROM pg_stat_activity
+WHERE datname = $1;
+"""
+
+
+class HealthConnection(psycopg2.extensions.connection):
+    """
+    Соединение, помнящее, подготовлен ли на нём pg_hc_stats.
 
-# Интегральный статус: 0=OK, 1=WARNING, 2=CRITICAL
-PG_STATUS = Gauge(
-    "airflow_pg_status",
-    "Airflow Postgres health status (0=OK,1=WARNING,2=CRITICAL)",
-)
+    execute_sql — готовый EXECUTE с уже подставленным именем БД (bytes),
+    чтобы не гонять подстановку параметров psycopg2 на каждом опросе.
+    """
+
+    execute_sql = None
+
+
+# ---------- Пул подключений к Postgres ----------
+
+# Пул создаётся лениво: при minconn=1 конструктор сразу открывает соединение,
+# а на старте экспортера база может быть недоступна.
+_POOL = None
+
+
+def get_pool(cfg: Config):
+    """Возвращаем пул подключений, создавая его при первом обращении."""
+    global _POOL
+    if _POOL is None:
+        # Пропавший по сети сервер замечаем на уровне TCP, а не по зависшему recv()
+        tcp_opts = {
+            "keepalives": 1,
+            "keepalives_idle": 30,
+            "keepalives_interval": 5,
+            "keepalives_count": 2,
+        }
+        # tcp_user_timeout есть только в libpq >= 12, более старый libpq отвергает DSN
+        if psycopg2.extensions.libpq_version() >= 120000:
+            tcp_opts["tcp_user_timeout"] = 3000
+
+        _POOL = psycopg2.pool.ThreadedConnectionPool(
+            1,
+            2,
+            host=cfg.pg_host,
+            port=cfg.pg_port,
+            dbname=cfg.pg_db,
+            user=cfg.pg_user,
+            password=cfg.pg_password,
+            connect_timeout=3,
+            application_name="airflow_pg_exporter",
+            connection_factory=HealthConnection,
+            # Зависший backend не должен блокировать опрос дольше scrape_timeout Prometheus
+            options="-c statement_timeout=2000 -c idle_in_transaction_session_timeout=5000",
+            **tcp_opts,
+        )
+    return _POOL
 
 
 def tcp_check(host: str, port: int, timeout: float = 3.0) -> bool:
     """Проверяем, что до Postgres можно достучаться по TCP."""
     try:
-        with closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as sock:
-            sock.settimeout(timeout)
-            sock.connect((host, port))
-        return True
+        with closing(socket.create_connection((host, port), timeout=timeout)):
+            return True
     except OSError:
         return False
 
 
-def scrape_once():
+def fetch_stats(conn, cfg: Config):
+    """Выполняем pg_hc_stats на соединении, возвращаем (latency_ms, строка)."""
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        if conn.execute_sql is None:
+            cur.execute(STATS_PREPARE_SQL)
+            conn.execute_sql = cur.mogrify("EXECUTE pg_hc_stats(%s);", (cfg.pg_db,))
+
+        start = time.monotonic_ns()
+        cur.execute(conn.execute_sql)
+        row = cur.fetchone()
+        return (time.monotonic_ns() - start) / 1_000_000, row
+
+
+def scrape_once(cfg: Config):
     """
     Один цикл опроса Postgres:
-    - TCP check
-    - SELECT 1
-    - pg_stat_activity
-    - обновление метрик.
+    - соединение из пула
+    - pg_stat_activity одним запросом (он же проверка живости)
+    - расчёт статуса.
+
+    Возвращает словарь значений по ключам из METRICS. Если Postgres
+    недоступен или запрос упал по statement_timeout, счётчики коннектов
+    в нём отсутствуют, а в последнем случае есть ещё флаг timed_out.
     """
     status = 0  # 0=OK,1=WARNING,2=CRITICAL
-
-    # ---------- TCP check ----------
-    if not tcp_check(PG_HOST, PG_PORT):
-        PG_UP.set(0)
-        PG_LATENCY_MS.set(-1)
-        PG_STATUS.set(2)
-        # Остальные gauge оставим как есть (последние значения)
-        return
+    down = {"up": 0, "latency_ms": -1, "status": 2}
 
     # ---------- Подключение к Postgres ----------
+    # Отдельный TCP check не нужен: недоступность БД libpq вернёт
+    # как OperationalError в пределах connect_timeout. Ловим любой
+    # psycopg2.Error, чтобы /metrics отдал airflow_pg_up 0, а не 500
     try:
-        conn = psycopg2.connect(
-            host=PG_HOST,
-            port=PG_PORT,
-            dbname=PG_DB,
-            user=PG_USER,
-            password=PG_PASSWORD,
-            connect_timeout=3,
-            application_name="airflow_pg_exporter",
-        )
-        conn.autocommit = True
-    except OperationalError:
-        PG_UP.set(0)
-        PG_LATENCY_MS.set(-1)
-        PG_STATUS.set(2)
-        return
+        pool = get_pool(cfg)
+    except psycopg2.Error:
+        return down
+
+    # Соединение из пула могло умереть на стороне сервера (рестарт/failover,
+    # pg_terminate_backend, idle_session_timeout) — тогда один раз повторяем
+    # на свежем соединении и только после второй неудачи считаем БД недоступной
+    for _ in range(2):
+        try:
+            conn = pool.getconn()
+        except psycopg2.Error:
+            return down
+
+        try:
+            latency_ms, row = fetch_stats(conn, cfg)
+            (
+                db_total,
+                db_active,
+                db_idle_in_tx,
+                af_total,
+                af_active,
+                af_idle_in_tx,
+            ) = row
+        except QueryCanceled:
+            # Сработал statement_timeout: БД отвечает, но не успевает
+            pool.putconn(conn)
+            return {"up": 1, "latency_ms": -1, "status": 2, "timed_out": True}
+        except (OperationalError, InterfaceError):
+            # Соединение сломано — выбрасываем его из пула, при повторе
+            # пул переподключится и заново подготовит pg_hc_stats
+            pool.putconn(conn, close=True)
+            continue
+        except Exception:
+            # Запрос упал, но соединение живо: счётчики не выдумываем
+            pool.putconn(conn)
+            return {"up": 1, "latency_ms": -1, "status": 2}
+        pool.putconn(conn)
+        break
+    else:
+        return down
 
-    PG_UP.set(1)
+    # ---------- Анализ порогов ----------
+    if latency_ms > cfg.warn_latency_ms:
+        status = max(status, 1)
 
-    latency_ms = -1
-    db_total = db_active = db_idle_in_tx = 0
-    af_total = af_active = af_idle_in_tx = 0
+    if db_idle_in_tx > cfg.warn_idle_in_tx:
+        status = max(status, 1)
+    if db_active > cfg.warn_active_conn:
+        status = max(status, 1)
 
-    try:
-        with conn.cursor() as cur:
-            # ---------- SELECT 1 ----------
-            start = time.time()
-            cur.execute("SELECT 1;")
-            row = cur.fetchone()
-            latency_ms = (time.time() - start) * 1000
-
-            if row != (1,):
-                status = max(status, 2)
-
-            # ---------- Общая стата по сессиям ----------
-            cur.execute(
-                """
-                SELECT
-                    SUM(CASE WHEN state = 'active' THEN 1 ELSE 0 END) AS active,
-                    SUM(CASE WHEN state = 'idle in transaction' THEN 1 ELSE 0 END) AS idle_in_tx,
-                    COUNT(*) AS total
-                FROM pg_stat_activity
-                WHERE datname = %s;
-                """,
-                (PG_DB,),
-            )
-            db_active, db_idle_in_tx, db_total = cur.fetchone() or (0, 0, 0)
-
-            # ---------- Только Airflow/Celery ----------
-            cur.execute(
-                """
-                SELECT
-                    SUM(CASE WHEN state = 'active' THEN 1 ELSE 0 END) AS active,
-                    SUM(CASE WHEN state = 'idle in transaction' THEN 1 ELSE 0 END) AS idle_in_tx,
-                    COUNT(*) AS total
-                FROM pg_stat_activity
-                WHERE datname = %s
-                  AND (application_name ILIKE 'airflow%%'
-                       OR application_name ILIKE 'celery%%');
-                """,
-                (PG_DB,),
-            )
-            af_active, af_idle_in_tx, af_total = cur.fetchone() or (0, 0, 0)
+    return {
+        "up": 1,
+        "latency_ms": latency_ms,
+        "db_total": db_total,
+        "db_active": db_active,
+        "db_idle_in_tx": db_idle_in_tx,
+        "af_total": af_total,
+        "af_active": af_active,
+        "af_idle_in_tx": af_idle_in_tx,
+        "status": status,
+    }
 
-    except Exception:
-        status = max(status, 2)
-    finally:
-        conn.close()
 
-    # ---------- Анализ порогов ----------
-    if latency_ms >= 0:
-        PG_LATENCY_MS.set(latency_ms)
-        if latency_ms > WARN_LATENCY_MS:
-            status = max(status, 1)
-    else:
-        PG_LATENCY_MS.set(-1)
-        status = max(status, 2)
+class PgHealthCollector(Collector):
+    """
+    Опрашивает Postgres синхронно на запрос /metrics.
 
-    PG_DB_TOTAL.set(db_total)
-    PG_DB_ACTIVE.set(db_active)
-    PG_DB_IDLE_IN_TX.set(db_idle_in_tx)
+    Результат кэшируется на cfg.cache_ttl секунд, чтобы несколько Prometheus
+    (или федерация) не умножали нагрузку на БД.
+    """
 
-    PG_AF_TOTAL.set(af_total)
-    PG_AF_ACTIVE.set(af_active)
-    PG_AF_IDLE_IN_TX.set(af_idle_in_tx)
+    def __init__(self, cfg: Config):
+        self._cfg = cfg
+        self._lock = threading.Lock()
+        self._last_ts = None
+        self._last_values = None
+        self._timeouts = 0
+
+    def _scrape(self):
+        """Возвращаем значения метрик, их возраст в секундах и число таймаутов."""
+        with self._lock:
+            now = time.monotonic()
+            if self._last_ts is None or now - self._last_ts >= self._cfg.cache_ttl:
+                self._last_values = scrape_once(self._cfg)
+                if self._last_values.get("timed_out"):
+                    self._timeouts += 1
+                self._last_ts = time.monotonic()
+                now = self._last_ts
+            return self._last_values, now - self._last_ts, self._timeouts
+
+    def describe(self):
+        # Без describe() REGISTRY.register вызвал бы collect() и сходил в БД
+        for _, name, documentation in METRICS:
+            yield GaugeMetricFamily(name, documentation)
+        yield GaugeMetricFamily("airflow_pg_scrape_age_seconds", SCRAPE_AGE_DOC)
+        yield CounterMetricFamily("airflow_pg_scrape_timeouts", SCRAPE_TIMEOUTS_DOC)
+
+    def collect(self):
+        values, age, timeouts = self._scrape()
+        for key, name, documentation in METRICS:
+            if key in values:
+                yield GaugeMetricFamily(name, documentation, value=values[key])
+        yield GaugeMetricFamily("airflow_pg_scrape_age_seconds", SCRAPE_AGE_DOC, value=age)
+        yield CounterMetricFamily(
+            "airflow_pg_scrape_timeouts", SCRAPE_TIMEOUTS_DOC, value=timeouts
+        )
 
-    if db_idle_in_tx > WARN_IDLE_IN_TX:
-        status = max(status, 1)
-    if db_active > WARN_ACTIVE_CONN:
-        status = max(status, 1)
 
-    PG_STATUS.set(status)
+def main():
+    cfg = load_config()
 
+    # Разовая проверка на старте, дальше доступность видна по airflow_pg_up
+    if not tcp_check(cfg.pg_host, cfg.pg_port):
+        print(f"Warning: Postgres {cfg.pg_host}:{cfg.pg_port} is not reachable over TCP")
 
-def main():
-    # Стартуем HTTP-сервер для /metrics
-    start_http_server(EXPORTER_PORT, addr=EXPORTER_ADDR)
+    REGISTRY.register(PgHealthCollector(cfg))
+    # Стартуем HTTP-сервер для /metrics, опрос БД идёт только при запросе метрик
+    start_http_server(cfg.exporter_port, addr=cfg.exporter_addr)
     print(
-        f"Starting Airflow↔Postgres exporter on {EXPORTER_ADDR}:{EXPORTER_PORT}, "
-        f"scrape interval {SCRAPE_INTERVAL}s"
+        f"Starting Airflow↔Postgres exporter on {cfg.exporter_addr}:{cfg.exporter_port}, "
+        f"cache ttl {cfg.cache_ttl}s"
     )
     while True:
-        scrape_once()
-        time.sleep(SCRAPE_INTERVAL)
+        time.sleep(3600)
 
 
 if __name__ == "__main__":